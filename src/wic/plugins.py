@@ -1,10 +1,15 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import copy
 import logging
-import glob
+import json
+import multiprocessing
 import os
 from pathlib import Path
+import pickle
 import re
-from typing import Dict
+import tempfile
+from typing import Any, Dict, ItemsView, Iterator, List, MutableMapping, Tuple, ValuesView
 
 import cwltool.load_tool
 import yaml
@@ -13,6 +18,14 @@ from . import input_output as io
 from .python_cwl_adapter import import_python_file
 from .wic_types import Cwl, NodeData, RoseTree, StepId, Tool, Tools
 
+# Use the libyaml bindings (if available), which are much faster than the pure python loader.
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader  # type: ignore[assignment]
+    print('Warning! libyaml is not available; loading CWL files will be slow.')
+    print('Please reinstall pyyaml with libyaml support.')
+
 
 # Filter out the "... previously defined" id uniqueness validation warnings
 # from line 1162 of ref_resolver.py in the schema_salad library.
@@ -20,14 +33,23 @@ from .wic_types import Cwl, NodeData, RoseTree, StepId, Tool, Tools
 class NoPreviouslyDefinedFilter(logging.Filter):
     # pylint:disable=too-few-public-methods
     def filter(self, record: logging.LogRecord) -> bool:
+        # Check the unformatted msg first, so we don't format records we are going to discard anyway.
+        if isinstance(record.msg, str) and record.msg.endswith('previously defined'):
+            return False
         return not record.getMessage().endswith('previously defined')
 
 
+RESOLVED_RE = re.compile(r"Resolved '.*' to '.*'")
+
+
 class NoResolvedFilter(logging.Filter):
     # pylint:disable=too-few-public-methods
     def filter(self, record: logging.LogRecord) -> bool:
-        m = re.match(r"Resolved '.*' to '.*'", record.getMessage())
-        return not bool(m)  # (True if m else False)
+        # Check the unformatted msg first, so we don't format every (unrelated) record.
+        # (Unless msg starts with a format specifier, which could itself expand to 'Resolved ...')
+        if isinstance(record.msg, str) and not record.msg.startswith(('Resolved ', '%')):
+            return True
+        return RESOLVED_RE.match(record.getMessage()) is None
 
 
 class NoPartialFailureNullWarning(logging.Filter):
@@ -72,9 +94,314 @@ def validate_cwl(cwl_path_str: str, skip_schemas: bool) -> None:
     # return process_ # ignore process_ for now
 
 
+# The minimum number of (uncached) CWL files for which load_cwl_files() uses a process pool.
+# NOTE: Parsing takes ~0.3-1ms per file, but each file costs another ~0.1ms to send back
+# from the workers, and starting forked workers costs ~20ms, so smaller batches are slower.
+parallel_min_files = 512
+
+# Parsed CWL files, keyed by absolute path and invalidated by (st_mtime_ns, st_size).
+# NOTE: Use pickle (not json) so the cached tools are identical to a fresh yaml.safe_load,
+# i.e. YAML 1.1 keys like `on:` stay True (not 'true') and dates stay dates.
+# NOTE: Unpickling can run arbitrary code, so the cache must be trusted exactly as much as
+# the rest of autogenerated/ (which we write and then run). Since the path is relative
+# to the cwd, do not run wic in a directory where others can write autogenerated/.
+tools_cache_path = Path('autogenerated/schemas/tools_cache.pkl')
+
+
+def read_tools_cache() -> Dict[str, List[Any]]:
+    """Reads the cache of parsed CWL files written by get_tools_cwl()
+
+    Returns:
+        Dict[str, List[Any]]: A dict from absolute paths to [st_mtime_ns, st_size, cwl] triples
+    """
+    try:
+        with open(tools_cache_path, mode='rb') as f:
+            cache: Dict[str, List[Any]] = pickle.load(f)
+        return cache
+    except Exception:  # pylint:disable=broad-exception-caught
+        # A missing or corrupt cache is not an error; we just re-parse everything.
+        # (Unpickling corrupt data can raise almost anything.)
+        return {}
+
+
+def write_tools_cache(cache: Dict[str, List[Any]]) -> None:
+    """Writes the cache of parsed CWL files read by get_tools_cwl()\n
+    NOTE: Multiple processes (i.e. pytest --workers 8) may write the cache concurrently,
+    so write to a temporary file and atomically replace the cache.
+
+    Args:
+        cache (Dict[str, List[Any]]): A dict from absolute paths to [st_mtime_ns, st_size, cwl] triples
+    """
+    tools_cache_path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=tools_cache_path.parent, suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode='wb') as f:
+            pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, tools_cache_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def prune_tools_cache(cache: Dict[str, List[Any]]) -> Dict[str, List[Any]]:
+    """Removes the entries of the cache whose CWL files have changed or no longer exist
+
+    Args:
+        cache (Dict[str, List[Any]]): A dict from absolute paths to [st_mtime_ns, st_size, cwl] triples
+
+    Returns:
+        Dict[str, List[Any]]: The entries of cache which are still valid
+    """
+    cache_valid: Dict[str, List[Any]] = {}
+    for cwl_path_abs, cached in cache.items():
+        try:
+            st = os.stat(cwl_path_abs)
+        except OSError:
+            continue
+        if cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+            cache_valid[cwl_path_abs] = cached
+    return cache_valid
+
+
+def scandir_suffix(root: str, suffix: str) -> Iterator[os.DirEntry]:
+    """Recursively finds all of the files within root whose names end with suffix.\n
+    This is equivalent to glob.glob(str(Path(root) / f'**/*{suffix}'), recursive=True)
+    (including the order and skipping hidden files and directories), but it avoids
+    fnmatch and it visits each directory entry exactly once.
+
+    Args:
+        root (str): The directory in which to search
+        suffix (str): The filename suffix (i.e. '.cwl')
+
+    Yields:
+        Iterator[os.DirEntry]: The matching files (and their cached stat() results)
+    """
+    try:
+        with os.scandir(root) as it:
+            entries = list(it)
+    except OSError:
+        return  # Just like glob, silently ignore nonexistent / unreadable directories
+    subdirs = []
+    for entry in entries:
+        if entry.name.startswith('.'):
+            continue
+        if entry.is_dir():
+            subdirs.append(entry.path)
+        elif entry.name.endswith(suffix) and entry.is_file():
+            yield entry
+    for subdir in subdirs:
+        yield from scandir_suffix(subdir, suffix)
+
+
+# The subset of json numbers which yaml (1.1) resolves as floats. yaml resolves the rest
+# (i.e. 1e3, 1.0e3) as strings. See yaml.resolver.Resolver
+YAML_FLOAT_RE = re.compile(r'-?[0-9]+\.[0-9]*(?:[eE][-+][0-9]+)?')
+
+
+def yaml_float(num: str) -> Any:
+    """Converts a json float literal the same way yaml.SafeLoader would.
+
+    Args:
+        num (str): A json float literal (i.e. 1.5 or 1e3)
+
+    Returns:
+        Any: A float if yaml would resolve num as a float, otherwise the string num
+    """
+    return float(num) if YAML_FLOAT_RE.fullmatch(num) else num
+
+
+def json_constant(name: str) -> Any:
+    """Rejects the non-standard json constants NaN, Infinity, and -Infinity
+
+    Args:
+        name (str): The name of the constant
+
+    Raises:
+        ValueError: Always, so that yaml parses the file instead (which yields a string).
+    """
+    raise ValueError(f'Non-standard json constant {name}')
+
+
+def load_cwl_file(cwl_path_str: str) -> Cwl:
+    """Parses a single CWL file, using the json parser if it looks like json.\n
+    NOTE: This needs to be a top-level function so that it can be pickled by ProcessPoolExecutor.
+
+    Args:
+        cwl_path_str (str): The path to the CWL file.
+
+    Returns:
+        Cwl: The parsed CWL file
+    """
+    with open(cwl_path_str, mode='r', encoding='utf-8') as f:
+        # CWL files can also be written in json (which is a subset of yaml),
+        # and the json parser is much faster than even libyaml.
+        if f.read(64).lstrip().startswith('{'):
+            f.seek(0)
+            try:
+                # NOTE: The hooks make the result identical to yaml.load(f, Loader=SafeLoader).
+                tool: Cwl = json.load(f, parse_float=yaml_float, parse_constant=json_constant)
+                return tool
+            except ValueError:
+                pass  # i.e. yaml flow style; let yaml handle it.
+        f.seek(0)
+        tool = yaml.load(f, Loader=SafeLoader)
+    return tool
+
+
+def load_cwl_files(cwl_paths: List[str]) -> List[Cwl]:
+    """Parses the given CWL files, in parallel if there are enough of them.\n
+    NOTE: yaml parsing is CPU bound and does not release the GIL (even with libyaml), so use processes.
+
+    Args:
+        cwl_paths (List[str]): The paths to the CWL files.
+
+    Returns:
+        List[Cwl]: The parsed CWL files, in the same order as cwl_paths
+    """
+    # Starting the worker processes is not free, so only use them for many files, and only if
+    # they are forked. (spawn and forkserver workers re-import cwltool, which takes ~0.5s.)
+    # NOTE: Do not call get_start_method() without allow_none, since that would fix the default.
+    start_method = multiprocessing.get_start_method(allow_none=True) or multiprocessing.get_all_start_methods()[0]
+    if len(cwl_paths) >= parallel_min_files and (os.cpu_count() or 1) > 1 and start_method == 'fork':
+        try:
+            with ProcessPoolExecutor() as executor:
+                return list(executor.map(load_cwl_file, cwl_paths, chunksize=16))
+        except (OSError, BrokenProcessPool):
+            pass  # i.e. if the workers cannot be started (or crash); just parse the files here.
+    return [load_cwl_file(cwl_path_str) for cwl_path_str in cwl_paths]
+
+
+class LazyTools(MutableMapping[StepId, Tool]):
+    """The CWL CommandLineTool definitions returned by get_tools_cwl().\n
+    All of the keys are known up front, but each CWL file is only parsed on first access
+    (unless it is cached), so enumerating the tool names does not require parsing anything.
+    Iterating over the values (i.e. .items()) parses all of the remaining files at once.\n
+    NOTE: get_validator() iterates over .items(), so currently every caller parses every file.
+    """
+
+    def __init__(self, cache: Dict[str, List[Any]], quiet: bool) -> None:
+        self.cache = cache
+        self.cache_new: Dict[str, List[Any]] = {}
+        self.cache_dirty = False
+        self.quiet = quiet
+        # NOTE: order contains every key, and each key is in exactly one of tools or unparsed.
+        self.order: Dict[StepId, None] = {}
+        self.tools: Dict[StepId, Tool] = {}
+        self.unparsed: Dict[StepId, Tuple[str, os.stat_result]] = {}
+
+    def add(self, stepid: StepId, cwl_path_abs: str, st: os.stat_result) -> None:
+        """Adds the CWL file cwl_path_abs, which will be parsed on first access (unless it is cached).
+
+        Args:
+            stepid (StepId): The key under which to add the CWL file
+            cwl_path_abs (str): The absolute path to the CWL file.
+            st (os.stat_result): The result of os.stat(cwl_path_abs)
+        """
+        cached = self.cache.get(cwl_path_abs)
+        if cached is not None and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+            self.cache_new[cwl_path_abs] = cached
+            self[stepid] = self.make_tool(stepid, cwl_path_abs, cached[2])
+        else:
+            self.tools.pop(stepid, None)
+            self.unparsed[stepid] = (cwl_path_abs, st)
+            self.order[stepid] = None
+
+    def make_tool(self, stepid: StepId, cwl_path_abs: str, cwl: Cwl) -> Tool:
+        """Creates the Tool for stepid, capturing stdout and stderr if quiet.
+
+        Args:
+            stepid (StepId): The key of the tool
+            cwl_path_abs (str): The absolute path to the CWL file.
+            cwl (Cwl): The parsed CWL file
+
+        Returns:
+            Tool: The Tool for stepid
+        """
+        if self.quiet:
+            # Capture stdout and stderr
+            # NOTE: Copy so that the cache stores the tool as-is on disk.
+            cwl = copy.copy(cwl)
+            if not 'stdout' in cwl:
+                cwl.update({'stdout': f'{stepid.stem}.out'})
+            if not 'stderr' in cwl:
+                cwl.update({'stderr': f'{stepid.stem}.err'})
+        return Tool(cwl_path_abs, cwl)
+
+    def load(self, stepids: List[StepId]) -> None:
+        """Parses the CWL files for the given (unparsed) stepids. See write_cache()\n
+        NOTE: If parsing raises an exception, all of the stepids remain unparsed.
+
+        Args:
+            stepids (List[StepId]): The keys to parse
+        """
+        paths_st = [self.unparsed[stepid] for stepid in stepids]
+        cwls = load_cwl_files([cwl_path_abs for cwl_path_abs, st in paths_st])
+        for stepid, (cwl_path_abs, st), cwl in zip(stepids, paths_st, cwls):
+            del self.unparsed[stepid]
+            self.cache_new[cwl_path_abs] = [st.st_mtime_ns, st.st_size, cwl]
+            self.tools[stepid] = self.make_tool(stepid, cwl_path_abs, cwl)
+        self.cache_dirty = True
+
+    def load_all(self) -> None:
+        """Parses all of the remaining CWL files at once (in parallel, if there are enough of them),
+        and then writes the cache."""
+        if self.unparsed:
+            self.load(list(self.unparsed))
+        self.write_cache()
+
+    def write_cache(self) -> None:
+        """Writes the cache (if it has changed), including all of the files parsed so far.\n
+        NOTE: Single lookups do not write the cache (which would then be written once per file),
+        so call this explicitly if you only look up some of the tools and want to cache them.
+        """
+        if self.cache_dirty or self.cache_new.keys() != self.cache.keys():
+            # Keep the (still valid) entries that this run did not find, i.e. from other homedirs
+            # or cwl_dirs.txt, so that using them from the same directory does not evict them.
+            cache_unused = {path: cached for path, cached in self.cache.items() if path not in self.cache_new}
+            cache = {**prune_tools_cache(cache_unused), **self.cache_new}
+            if self.cache_dirty or cache.keys() != self.cache.keys():
+                write_tools_cache(cache)
+            self.cache = cache
+            self.cache_new = dict(cache)
+            self.cache_dirty = False
+
+    def __getitem__(self, stepid: StepId) -> Tool:
+        if stepid in self.unparsed:
+            self.load([stepid])
+        return self.tools[stepid]
+
+    def __setitem__(self, stepid: StepId, tool: Tool) -> None:
+        self.unparsed.pop(stepid, None)
+        self.tools[stepid] = tool
+        self.order[stepid] = None
+
+    def __delitem__(self, stepid: StepId) -> None:
+        del self.order[stepid]
+        self.unparsed.pop(stepid, None)
+        self.tools.pop(stepid, None)
+
+    def __iter__(self) -> Iterator[StepId]:
+        return iter(self.order)
+
+    def __len__(self) -> int:
+        return len(self.order)
+
+    def __contains__(self, stepid: object) -> bool:
+        # NOTE: The default implementation calls __getitem__, which would parse the file.
+        return stepid in self.order
+
+    def values(self) -> ValuesView[Tool]:
+        self.load_all()
+        return super().values()
+
+    def items(self) -> ItemsView[StepId, Tool]:
+        self.load_all()
+        return super().items()
+
+
 def get_tools_cwl(homedir: str, validate_plugins: bool = False,
-                  skip_schemas: bool = False, quiet: bool = False) -> Tools:
-    """Uses glob() to find all of the CWL CommandLineTool definition files within any subdirectory of cwl_dir
+                  skip_schemas: bool = False, quiet: bool = False) -> LazyTools:
+    """Uses scandir_suffix() to find all of the CWL CommandLineTool definition files within any subdirectory of cwl_dir
 
     Args:
         homedir (str): The users home directory
@@ -84,46 +411,41 @@ def get_tools_cwl(homedir: str, validate_plugins: bool = False,
         quiet (bool, optional): Determines whether it captures stdout or stderr. Defaults to False.
 
     Returns:
-        Tools: The CWL CommandLineTool definitions found using glob()
+        LazyTools: The CWL CommandLineTool definitions found using scandir_suffix() (parsed on first access)
     """
     io.copy_config_files(homedir)
-    # Load ALL of the tools.
-    tools_cwl: Tools = {}
+    Path('autogenerated/schemas/tools/').mkdir(parents=True, exist_ok=True)
+    # Find ALL of the tools, but only parse them on first access.
+    tools_cwl = LazyTools(read_tools_cache(), quiet)
     cwl_dirs_file = Path(homedir) / 'wic' / 'cwl_dirs.txt'
     cwl_dirs = io.read_lines_pairs(cwl_dirs_file)
     for plugin_ns, cwl_dir in cwl_dirs:
         # "PurePath.relative_to() requires self to be the subpath of the argument, but os.path.relpath() does not."
         # See https://docs.python.org/3/library/pathlib.html#id4 and
         # See https://stackoverflow.com/questions/67452690/pathlib-path-relative-to-vs-os-path-relpath
-        pattern_cwl = str(Path(cwl_dir) / '**/*.cwl')
-        # print(pattern_cwl)
-        cwl_paths = glob.glob(pattern_cwl, recursive=True)
-        Path('autogenerated/schemas/tools/').mkdir(parents=True, exist_ok=True)
+        # NOTE: Since the root is absolute, so are all of the paths found within it.
+        cwl_root = os.path.abspath(cwl_dir)
+        cwl_paths = list(scandir_suffix(cwl_root, '.cwl'))
         if len(cwl_paths) == 0:
             print(f'Warning! No cwl files found in {cwl_dir}.\nCheck {cwl_dirs_file.absolute()}')
             print('This almost certainly means you are not in the correct directory.')
 
-        for cwl_path_str in cwl_paths:
-            if 'biobb_md' in cwl_path_str:
+        for entry in cwl_paths:
+            # NOTE: Only check the path within cwl_root, not the parent directories of the cwd.
+            if 'biobb_md' in entry.path[len(cwl_root):]:
                 continue  # biobb_md is deprecated (in favor of biobb_gromacs)
             # print(cwl_path)
-            with open(cwl_path_str, mode='r', encoding='utf-8') as f:
-                tool: Cwl = yaml.safe_load(f.read())
-            stem = Path(cwl_path_str).stem
+            stem = os.path.splitext(entry.name)[0]
             # print(stem)
-
             if validate_plugins:
-                validate_cwl(cwl_path_str, skip_schemas)
-            if quiet:
-                # Capture stdout and stderr
-                if not 'stdout' in tool:
-                    tool.update({'stdout': f'{stem}.out'})
-                if not 'stderr' in tool:
-                    tool.update({'stderr': f'{stem}.err'})
-            cwl_path_abs = os.path.abspath(cwl_path_str)
-            tools_cwl[StepId(stem, plugin_ns)] = Tool(cwl_path_abs, tool)
-            # print(tool)
+                validate_cwl(entry.path, skip_schemas)
+            tools_cwl.add(StepId(stem, plugin_ns), entry.path, entry.stat())
             # utils_graphs.make_tool_dag(stem, (cwl_path_str, tool))
+
+    if validate_plugins:
+        tools_cwl.load_all()
+    # NOTE: If all of the files were cached, we still need to remove stale entries.
+    tools_cwl.write_cache()
     return tools_cwl
 
 
@@ -272,7 +594,7 @@ def cwl_prepend_dockerFile_include_path_rosetree(rose_tree: RoseTree) -> RoseTre
 
 
 def get_workflow_paths(homedir: str, extension: str) -> Dict[str, Dict[str, Path]]:
-    """Uses glob() to recursively find all of the yml workflow definition files
+    """Uses scandir_suffix() to recursively find all of the yml workflow definition files
     within any subdirectory of each yml_dir in yml_dirs_file.
     NOTE: This function assumes all yml files found are workflow definition files,
     so do not mix regular yml files and workflow files in the same root directory.
@@ -286,6 +608,7 @@ def get_workflow_paths(homedir: str, extension: str) -> Dict[str, Dict[str, Path
         Dict[str, Dict[str, Path]]: A dict containing the filepath stem and filepath of each yml file
     """
     io.copy_config_files(homedir)
+    Path('autogenerated/schemas/workflows/').mkdir(parents=True, exist_ok=True)
     yml_dirs_file = Path(homedir) / 'wic' / 'yml_dirs.txt'
     yml_dirs = io.read_lines_pairs(yml_dirs_file)
     # Glob all of the yml files too, so we don't have to deal with relative paths.
@@ -294,19 +617,24 @@ def get_workflow_paths(homedir: str, extension: str) -> Dict[str, Dict[str, Path
         # "PurePath.relative_to() requires self to be the subpath of the argument, but os.path.relpath() does not."
         # See https://docs.python.org/3/library/pathlib.html#id4 and
         # See https://stackoverflow.com/questions/67452690/pathlib-path-relative-to-vs-os-path-relpath
-        pattern_yml = str(Path(yml_dir) / f'**/*.{extension}')
-        yml_paths_sorted = sorted(glob.glob(pattern_yml, recursive=True), key=len, reverse=True)
-        Path('autogenerated/schemas/workflows/').mkdir(parents=True, exist_ok=True)
-        if len(yml_paths_sorted) == 0:
+        # NOTE: Since the root is absolute, so are all of the paths found within it.
+        yml_root = os.path.abspath(yml_dir)
+        yml_paths_found = list(scandir_suffix(yml_root, f'.{extension}'))
+        if len(yml_paths_found) == 0:
             print(f'Warning! No {extension} files found in {yml_dir}.\nCheck {yml_dirs_file.absolute()}')
             print('This almost certainly means you are not in the correct directory.')
-        yml_paths = {}
-        for yml_path_str in yml_paths_sorted:
+        # If there are multiple files with the same stem, use the shortest path.
+        # (On ties, the last one found wins.)
+        yml_paths_shortest: Dict[str, str] = {}
+        for entry in yml_paths_found:
             # Exclude our autogenerated inputs files
-            if '_inputs' not in yml_path_str:
-                yml_path = Path(yml_path_str)
-                yml_path_abs = os.path.abspath(yml_path_str)
-                yml_paths[yml_path.stem] = Path(yml_path_abs)
+            # NOTE: Only check the path within yml_root, not the parent directories of the cwd.
+            if '_inputs' not in entry.path[len(yml_root):]:
+                stem = os.path.splitext(entry.name)[0]
+                prev = yml_paths_shortest.get(stem)
+                if prev is None or len(entry.path) <= len(prev):
+                    yml_paths_shortest[stem] = entry.path
+        yml_paths = {stem: Path(yml_path_abs) for stem, yml_path_abs in yml_paths_shortest.items()}
         # Check for existing entry (so we can split a single
         # namespace across multiple lines in yml_dirs.txt)
         ns_dict = yml_paths_all.get(yml_namespace, {})
@@ -1,4 +1,4 @@
-from typing import Any, Dict, List, NamedTuple, Tuple
+from typing import Any, Dict, List, MutableMapping, NamedTuple, Tuple
 
 import networkx as nx
 
@@ -32,7 +32,8 @@ class StepId(NamedTuple):
     plugin_ns: str  # left column of yml_paths.txt
 
 
-Tools = Dict[StepId, Tool]
+# NOTE: Not Dict, so that get_tools_cwl() can parse the tools lazily. See plugins.LazyTools
+Tools = MutableMapping[StepId, Tool]
 
 # NOTE: Please read the Namespacing section of docs/devguide.md !!!
 Namespace = str
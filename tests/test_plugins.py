@@ -0,0 +1,284 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import logging
+import multiprocessing
+from pathlib import Path
+import pickle
+from typing import Any, Dict, List
+
+import pytest
+import yaml
+
+import wic.plugins
+from wic.wic_types import StepId, Tool
+
+
+TOOL_CWL = """cwlVersion: v1.0
+class: CommandLineTool
+baseCommand: echo
+inputs: {}
+outputs: {}
+"""
+
+
+@pytest.fixture(name='homedir')
+def homedir_fixture(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    """Creates a temporary homedir whose cwl_dirs.txt and yml_dirs.txt point to
+    (initially empty) cwl/ and yml/ directories, and changes into it so that
+    autogenerated/ (including the tools cache) is also temporary.
+    """
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'wic').mkdir()
+    (tmp_path / 'wic' / 'cwl_dirs.txt').write_text('global cwl\n', encoding='utf-8')
+    (tmp_path / 'wic' / 'yml_dirs.txt').write_text('global yml\n', encoding='utf-8')
+    (tmp_path / 'cwl').mkdir()
+    (tmp_path / 'yml').mkdir()
+    return tmp_path
+
+
+@pytest.mark.fast
+def test_tools_cache_round_trip(homedir: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Tests that tools loaded from the cache are identical to freshly parsed tools,
+    including non-string YAML 1.1 keys (i.e. `on:` is True) and dates."""
+    (homedir / 'cwl' / 'tool.cwl').write_text(TOOL_CWL + 'on: 2024-01-01\n', encoding='utf-8')
+    stepid = StepId('tool', 'global')
+
+    tools = wic.plugins.get_tools_cwl(str(homedir))
+    cold = tools[stepid].cwl
+    tools.write_cache()
+    assert wic.plugins.tools_cache_path.exists()
+    with open(wic.plugins.tools_cache_path, mode='rb') as f:
+        assert len(pickle.load(f)) == 1
+
+    # The warm start must not parse anything.
+    monkeypatch.setattr(wic.plugins, 'load_cwl_files', None)
+    warm = wic.plugins.get_tools_cwl(str(homedir))[stepid].cwl
+    assert True in cold
+    assert warm == cold
+    assert [type(key) for key in warm] == [type(key) for key in cold]
+
+
+@pytest.mark.fast
+def test_tools_cache_keeps_other_dirs(homedir: Path) -> None:
+    """Tests that switching cwl_dirs.txt keeps the (still valid) cache entries of the other
+    directory, and that entries whose files no longer exist are removed."""
+    (homedir / 'cwl2').mkdir()
+    (homedir / 'cwl' / 'a.cwl').write_text(TOOL_CWL, encoding='utf-8')
+    (homedir / 'cwl2' / 'b.cwl').write_text(TOOL_CWL, encoding='utf-8')
+    cwl_dirs_file = homedir / 'wic' / 'cwl_dirs.txt'
+    paths = [str(homedir / 'cwl' / 'a.cwl'), str(homedir / 'cwl2' / 'b.cwl')]
+
+    list(wic.plugins.get_tools_cwl(str(homedir)).items())
+    cwl_dirs_file.write_text('global cwl2\n', encoding='utf-8')
+    list(wic.plugins.get_tools_cwl(str(homedir)).items())
+    assert sorted(wic.plugins.read_tools_cache()) == paths
+
+    (homedir / 'cwl' / 'a.cwl').unlink()
+    wic.plugins.get_tools_cwl(str(homedir))
+    assert list(wic.plugins.read_tools_cache()) == paths[1:]
+
+
+@pytest.mark.fast
+def test_no_previously_defined_filter() -> None:
+    """Tests that NoPreviouslyDefinedFilter removes schema_salad's "... previously defined" messages,
+    whether the suffix is in the template or only in the '%s'-expanded message, and nothing else."""
+    def record(msg: str, *args: str) -> logging.LogRecord:
+        return logging.LogRecord('salad', logging.WARNING, __file__, 0, msg, args, None)
+
+    defined_filter = wic.plugins.NoPreviouslyDefinedFilter()
+    assert not defined_filter.filter(record('%s object %s %r previously defined', 'file:///a.cwl', 'id', 'x'))
+    assert not defined_filter.filter(record('%s', 'file:///a.cwl object id x previously defined'))
+    assert defined_filter.filter(record('%s previously defined elsewhere', 'x'))
+    assert defined_filter.filter(record('Some other message %s', 'x'))
+
+
+@pytest.mark.fast
+def test_no_resolved_filter() -> None:
+    """Tests that NoResolvedFilter removes cwltool's "Resolved '%s' to '%s'" messages
+    (including paths with apostrophes) and nothing else."""
+    def record(msg: str, *args: str) -> logging.LogRecord:
+        return logging.LogRecord('cwltool', logging.INFO, __file__, 0, msg, args, None)
+
+    resolved_filter = wic.plugins.NoResolvedFilter()
+    assert not resolved_filter.filter(record("Resolved '%s' to '%s'", 'a.cwl', 'file:///a.cwl'))
+    assert not resolved_filter.filter(record("Resolved '%s' to '%s'", "it's.cwl", "file:///it's.cwl"))
+    assert not resolved_filter.filter(record('%s', "Resolved 'a.cwl' to 'file:///a.cwl'"))
+    assert resolved_filter.filter(record('Resolved %s', 'a.cwl'))
+    assert resolved_filter.filter(record('Some other message %s', 'a.cwl'))
+
+
+@pytest.mark.fast
+@pytest.mark.parametrize("num", ['1', '-0', '1.5', '-0.5', '1.0e+3', '1.5E-2', '1e3', '1.0e3', '1E+3', '2.'])
+def test_load_cwl_file_json_matches_yaml(tmp_path: Path, num: str) -> None:
+    """Tests that the json fast path in load_cwl_file returns exactly what yaml.safe_load returns."""
+    cwl_path = tmp_path / 'tool.cwl'
+    cwl_path.write_text(f'{{"class": "CommandLineTool", "x": [{num}, true, null, "a\\/b"]}}', encoding='utf-8')
+    cwl = wic.plugins.load_cwl_file(str(cwl_path))
+    expected = yaml.safe_load(cwl_path.read_text(encoding='utf-8'))
+    assert cwl == expected
+    assert [type(x) for x in cwl['x']] == [type(x) for x in expected['x']]
+
+
+@pytest.mark.fast
+def test_load_cwl_file_json_constants(tmp_path: Path) -> None:
+    """Tests that NaN and Infinity fall back to yaml (which parses them as strings)."""
+    cwl_path = tmp_path / 'tool.cwl'
+    cwl_path.write_text('{"x": NaN, "y": Infinity}', encoding='utf-8')
+    assert wic.plugins.load_cwl_file(str(cwl_path)) == {'x': 'NaN', 'y': 'Infinity'}
+
+
+@pytest.mark.fast
+@pytest.mark.skipif(multiprocessing.get_all_start_methods()[0] != 'fork',
+                    reason='load_cwl_files only uses a process pool with fork')
+def test_load_cwl_files_pool_matches_serial(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Tests that load_cwl_files returns the same tools (in the same order) with and without the
+    process pool, and that it falls back to parsing serially if the pool cannot be started."""
+    cwl_paths = []
+    for i in range(40):
+        cwl_path = tmp_path / f'tool{i}.cwl'
+        cwl_path.write_text(TOOL_CWL + f'id: tool{i}\n', encoding='utf-8')
+        cwl_paths.append(str(cwl_path))
+    serial = wic.plugins.load_cwl_files(cwl_paths)
+    assert [cwl['id'] for cwl in serial] == [f'tool{i}' for i in range(40)]
+
+    # NOTE: Also pretend to have multiple cpus, so that the pool is used on single cpu machines.
+    monkeypatch.setattr(wic.plugins, 'parallel_min_files', 0)
+    monkeypatch.setattr(wic.plugins.os, 'cpu_count', lambda: 2)
+    executors: List[ProcessPoolExecutor] = []
+
+    class ProcessPoolExecutorSpy(ProcessPoolExecutor):
+        def __init__(self) -> None:
+            executors.append(self)
+            super().__init__(max_workers=2)
+
+    monkeypatch.setattr(wic.plugins, 'ProcessPoolExecutor', ProcessPoolExecutorSpy)
+    assert wic.plugins.load_cwl_files(cwl_paths) == serial
+    assert len(executors) == 1
+
+    def broken_pool() -> None:
+        raise BrokenProcessPool()
+
+    monkeypatch.setattr(wic.plugins, 'ProcessPoolExecutor', broken_pool)
+    assert wic.plugins.load_cwl_files(cwl_paths) == serial
+
+
+def write_tools(homedir: Path, stems: List[str]) -> List[StepId]:
+    """Writes a trivial CWL CommandLineTool for each stem into homedir/cwl/"""
+    for stem in stems:
+        (homedir / 'cwl' / f'{stem}.cwl').write_text(TOOL_CWL, encoding='utf-8')
+    return [StepId(stem, 'global') for stem in stems]
+
+
+@pytest.mark.fast
+def test_lazy_tools_lookup(homedir: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Tests that get_tools_cwl only parses a tool when it is looked up, that lookups do not
+    write the cache, and that write_cache() caches them even if the other tools are never parsed."""
+    stepids = write_tools(homedir, ['a', 'b', 'c'])
+    tools = wic.plugins.get_tools_cwl(str(homedir), quiet=True)
+    assert isinstance(tools, wic.plugins.LazyTools)
+    assert sorted(tools) == sorted(stepids)
+    assert len(tools) == 3 and stepids[0] in tools and StepId('d', 'global') not in tools
+    assert len(tools.unparsed) == 3
+
+    tool = tools[stepids[0]]
+    assert tool.run_path == str(homedir / 'cwl' / 'a.cwl')
+    assert tool.cwl['baseCommand'] == 'echo' and tool.cwl['stdout'] == 'a.out'
+    assert len(tools.unparsed) == 2
+    assert tools.get(StepId('d', 'global')) is None
+
+    writes: List[Dict[str, List[Any]]] = []
+    write_tools_cache = wic.plugins.write_tools_cache
+
+    def write_tools_cache_spy(cache: Dict[str, List[Any]]) -> None:
+        writes.append(cache)
+        write_tools_cache(cache)
+
+    monkeypatch.setattr(wic.plugins, 'write_tools_cache', write_tools_cache_spy)
+    _ = tools[stepids[1]]
+    assert not writes
+    tools.write_cache()
+    tools.write_cache()
+    assert len(writes) == 1
+
+    # NOTE: The cache stores the tools as-is on disk, i.e. without stdout / stderr.
+    cache = wic.plugins.read_tools_cache()
+    assert sorted(cache) == [tool.run_path, str(homedir / 'cwl' / 'b.cwl')]
+    assert 'stdout' not in cache[tool.run_path][2]
+    tools = wic.plugins.get_tools_cwl(str(homedir), quiet=True)
+    assert len(tools.unparsed) == 1
+
+
+@pytest.mark.fast
+def test_lazy_tools_items(homedir: Path) -> None:
+    """Tests that items() and values() parse all of the remaining tools, in order."""
+    stepids = write_tools(homedir, ['a', 'b', 'c'])
+    tools = wic.plugins.get_tools_cwl(str(homedir))
+    items = list(tools.items())
+    assert not tools.unparsed
+    assert [stepid for stepid, tool in items] == list(tools)
+    assert all(tool.cwl['class'] == 'CommandLineTool' for tool in tools.values())
+    assert dict(tools) == {**tools} == dict(items)
+    assert sorted(wic.plugins.read_tools_cache()) == sorted(str(homedir / 'cwl' / f'{s}.cwl') for s in 'abc')
+
+    tools_copy = pickle.loads(pickle.dumps(tools))
+    assert tools_copy == tools
+
+
+@pytest.mark.fast
+def test_lazy_tools_parse_error(homedir: Path) -> None:
+    """Tests that a parse error is raised on every lookup (not just the first one)."""
+    stepids = write_tools(homedir, ['a'])
+    (homedir / 'cwl' / 'bad.cwl').write_text('class: [CommandLineTool\n', encoding='utf-8')
+    tools = wic.plugins.get_tools_cwl(str(homedir))
+    bad = StepId('bad', 'global')
+    for _ in range(2):
+        with pytest.raises(yaml.YAMLError):
+            _ = tools[bad]
+        with pytest.raises(yaml.YAMLError):
+            list(tools.items())
+    assert bad in tools.unparsed
+    assert tools[stepids[0]].cwl['class'] == 'CommandLineTool'
+
+
+@pytest.mark.fast
+def test_lazy_tools_update_pop(homedir: Path) -> None:
+    """Tests that update, setdefault, pop, popitem, and del behave like a dict (without placeholders)."""
+    stepid_a, stepid_b, _ = write_tools(homedir, ['a', 'b', 'c'])
+    tools = wic.plugins.get_tools_cwl(str(homedir))
+    tool_new = Tool('new.cwl', {'class': 'Workflow'})
+
+    tools.update({stepid_a: tool_new})
+    assert tools[stepid_a] is tool_new
+    assert tools.setdefault(stepid_a, Tool('other.cwl', {})) is tool_new
+
+    tool_b = tools.pop(stepid_b)
+    assert tool_b.cwl['class'] == 'CommandLineTool'
+    assert stepid_b not in tools and len(tools) == 2
+    assert tools.pop(stepid_b, None) is None
+    with pytest.raises(KeyError):
+        _ = tools[stepid_b]
+
+    _, tool_popped = tools.popitem()
+    assert tool_popped.cwl  # i.e. not an empty placeholder
+    del tools[next(iter(tools))]
+    assert len(tools) == 0 and not tools.unparsed
+
+
+@pytest.mark.fast
+def test_path_filters_ignore_parent_directories(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Tests that the biobb_md and _inputs exclusions only apply to the paths within
+    each directory in cwl_dirs.txt / yml_dirs.txt, not to their parent directories."""
+    homedir = tmp_path / 'biobb_md' / 'my_inputs'
+    homedir.mkdir(parents=True)
+    monkeypatch.chdir(homedir)
+    (homedir / 'wic').mkdir()
+    (homedir / 'wic' / 'cwl_dirs.txt').write_text('global cwl\n', encoding='utf-8')
+    (homedir / 'wic' / 'yml_dirs.txt').write_text('global yml\n', encoding='utf-8')
+    (homedir / 'cwl' / 'biobb_md').mkdir(parents=True)
+    (homedir / 'yml').mkdir()
+    write_tools(homedir, ['a', 'biobb_md/b'])
+    for stem in ['a', 'a_inputs']:
+        (homedir / 'yml' / f'{stem}.yml').write_text('steps: []\n', encoding='utf-8')
+
+    assert list(wic.plugins.get_tools_cwl(str(homedir))) == [StepId('a', 'global')]
+    assert wic.plugins.get_yml_paths(str(homedir)) == {'global': {'a': homedir / 'yml' / 'a.yml'}}